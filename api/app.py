@@ -1,39 +1,160 @@
 import os
 import google.generativeai as genai
-from flask import Flask, request, jsonify
+from google import genai as google_genai
+from flask import Flask, Request, Response, request, jsonify
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
-import uuid
-import json
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from prometheus_client import CollectorRegistry, Histogram, make_wsgi_app, multiprocess
+import io
+import tempfile
+import shutil
+import orjson
 from dotenv import load_dotenv
-import mimetypes
 import time # Import the time module
+import logging
+import logging.handlers
+import queue
+import atexit
+import random
+import hashlib
+import threading
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
 
 # --- Configuration ---
 load_dotenv()
 
+# Logging: LOG_LEVEL=DEBUG also logs transcripts and raw model output.
+# Records are formatted on the request thread (so threadName is the caller's),
+# queued, and written by a background listener thread, so request threads never
+# block on stdout. The listener's StreamHandler only prints the formatted message.
+_log_queue = queue.SimpleQueue()
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s [%(threadName)s] %(message)s",
+    handlers=[logging.handlers.QueueHandler(_log_queue)]
+)
+logger = logging.getLogger(__name__)
+
 # 1. Configure Gemini
 try:
     genai.configure(api_key=os.environ["GOOGLE_API_KEY"])
 except KeyError:
-    print("FATAL: GOOGLE_API_KEY environment variable not set.")
+    logger.critical("GOOGLE_API_KEY environment variable not set.")
     pass
 
-# --- Filesystem Paths ---
-# We still need the /tmp directory to save the audio file temporarily
-TEMP_DIR = "/tmp"
-os.makedirs(TEMP_DIR, exist_ok=True)
-
 # --- Initializations ---
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for faster jsonify()."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+# Werkzeug spools uploads over 500 KB to a temp file in /tmp, which can be a real
+# disk on managed hosts. Keep single recordings in memory up to 16 MB and spill
+# anything larger to tmpfs (/dev/shm), but only when it has room: /dev/shm is
+# often just 64 MB in containers, and running out fails the upload mid-parse.
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else None
+
+# Batches can total MAX_BATCH_BYTES, so they keep Werkzeug's small in-memory
+# threshold and spill to the regular temp dir, which must have room for them.
+BATCH_SPOOL_MAX_SIZE = 500 * 1024
+
+def shm_spool_dir(total_content_length):
+    """Returns /dev/shm if it can hold this upload twice over, else None (default temp dir)."""
+    if SHM_DIR is None or total_content_length is None:
+        return None
+    if total_content_length <= SPOOL_MAX_SIZE:
+        return SHM_DIR # Never spills
+    # Headroom for other uploads spilling concurrently
+    if shutil.disk_usage(SHM_DIR).free >= 2 * total_content_length:
+        return SHM_DIR
+    return None
+
+class AudioRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if self.endpoint == 'process_audio_batch':
+            return tempfile.SpooledTemporaryFile(max_size=BATCH_SPOOL_MAX_SIZE, mode="rb+")
+        return tempfile.SpooledTemporaryFile(
+            max_size=SPOOL_MAX_SIZE, mode="rb+", dir=shm_spool_dir(total_content_length)
+        )
+
 app = Flask(__name__)
+app.request_class = AudioRequest
+# Reject oversized uploads from the Content-Length header, before anything is spooled.
+# Single-recording endpoints get the global limit; the batch endpoint raises it per
+# request (see set_batch_upload_limit) and checks each file against the same cap.
+# Batch uploads spill to the regular temp dir (see AudioRequest), so each in-flight
+# batch needs up to MAX_BATCH_BYTES of free disk there; lower MAX_BATCH_FILES on
+# instances with a small /tmp.
+MAX_RECORDING_BYTES = 25 * 1024 * 1024
+MAX_BATCH_FILES = 10
+MAX_BATCH_BYTES = MAX_RECORDING_BYTES * MAX_BATCH_FILES
+app.config['MAX_CONTENT_LENGTH'] = MAX_RECORDING_BYTES
+app.json = OrjsonProvider(app)
 CORS(app)
 
+# --- Metrics ---
+# Per-stage Gemini latencies, exposed for Prometheus at /metrics. Under Gunicorn,
+# set PROMETHEUS_MULTIPROC_DIR so /metrics aggregates across all workers.
+UPLOAD_H = Histogram('gemini_upload_seconds', 'Time to upload audio to the Google File API')
+ACTIVATE_H = Histogram('gemini_file_activate_seconds', 'Time waiting for an uploaded file to become ACTIVE')
+TRANSCRIBE_H = Histogram('gemini_transcribe_seconds', 'Time for Gemini to transcribe a single field')
+EXTRACT_H = Histogram('gemini_extract_seconds', 'Time for the combined Gemini transcription + extraction call')
+
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+    metrics_app = make_wsgi_app(metrics_registry)
+else:
+    metrics_app = make_wsgi_app()
+app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {'/metrics': metrics_app})
+
+GEMINI_MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+
 # Initialize the Generative AI model
 try:
-    gemini_model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025')
+    gemini_model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 except Exception as e:
-    print(f"Error initializing Gemini model: {e}")
+    logger.error("Error initializing Gemini model: %s", e)
     gemini_model = None
 
+# File API and Batch API calls go through the newer google-genai SDK. Its client
+# keeps one pooled HTTP connection per worker, whereas google-generativeai's
+# upload_file fetches the discovery document and builds a new HTTP client (at least two
+# fresh TLS handshakes) on every upload.
+try:
+    genai_client = google_genai.Client(api_key=os.environ["GOOGLE_API_KEY"])
+except Exception as e:
+    logger.error("Error initializing Gemini client: %s", e)
+    genai_client = None
+
+# Deleting the uploaded file is one more round-trip to Google that the client
+# does not need to wait for, so it runs in the background after we respond.
+cleanup_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="gemini-cleanup")
+
+# Results keyed by (endpoint, SHA-256 of the audio), so a retried or duplicate
+# upload is answered without another upload or model call.
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+result_cache = TTLCache(maxsize=128, ttl=3600)
+result_cache_lock = threading.Lock() # TTLCache is not thread-safe
+
+# Accidental taps on the mic produce recordings that are too short to hold any
+# speech. They are rejected before calling Gemini: by block timestamps for webm
+# (what the browser records), and by a byte floor for formats we cannot parse.
+MIN_RECORDING_SECONDS = 0.5
+MIN_RECORDING_BYTES = 1024
+WEBM_MIME_TYPES = ('audio/webm', 'video/webm')
+
 # --- VOICE-FILLABLE SCHEMA ---
 VOICE_FILLABLE_SCHEMA = {
     'organised_by': "The name of the organization conducting the event.",
@@ -63,162 +184,364 @@ VOICE_FILLABLE_SCHEMA = {
     'treatment_plan': "The proposed treatment plan based on the examination."
 }
 
+# Response schema for the combined transcription + extraction call. Gemini
+# returns the schema fields plus the raw transcription in a single JSON object.
+RESPONSE_SCHEMA = genai.protos.Schema(
+    type=genai.protos.Type.OBJECT,
+    properties={
+        'transcribed_text': genai.protos.Schema(
+            type=genai.protos.Type.STRING,
+            description="The full transcription of the conversation, in its original language."
+        ),
+        **{
+            key: genai.protos.Schema(type=genai.protos.Type.STRING, description=description)
+            for key, description in VOICE_FILLABLE_SCHEMA.items()
+        },
+    },
+    required=['transcribed_text', *VOICE_FILLABLE_SCHEMA],
+)
+
+# Same schema in the dict form accepted by the google-genai SDK (used for batches).
+BATCH_RESPONSE_SCHEMA = {
+    'type': 'OBJECT',
+    'properties': {
+        key: {'type': 'STRING', 'description': schema.description}
+        for key, schema in RESPONSE_SCHEMA.properties.items()
+    },
+    'required': list(RESPONSE_SCHEMA.required),
+}
 
-# --- Helper Function ---
-def get_extension_from_mimetype(mime_type):
-    """Gets a file extension from a MIME type."""
-    if not mime_type:
-        return '.dat' # default extension
-    
-    if mime_type == 'audio/webm':
-        return '.webm'
-    if mime_type == 'audio/mpeg':
-        return '.mp3'
-    if mime_type == 'audio/mp4': # m4a is often sent as audio/mp4
-        return '.m4a'
-    if mime_type == 'audio/wav' or mime_type == 'audio/x-wav':
-        return '.wav'
-    if mime_type == 'audio/ogg':
-        return '.ogg'
-    
-    # Use mimetypes library as a fallback
-    extension = mimetypes.guess_extension(mime_type)
-    return extension if extension else '.dat'
+# The prompt does not depend on the request, so it is built once at import time.
+SCHEMA_DESCRIPTION = "\n".join(f'- "{key}": "{description}"' for key, description in VOICE_FILLABLE_SCHEMA.items())
+
+EXTRACTION_PROMPT = f"""
+You are an expert medical scribe specializing in dental forms. Your task is to transcribe the attached conversation audio and extract key information into a structured JSON object.
+
+First transcribe the entire conversation into "transcribed_text". Then analyze the transcript and fill in the values for the following JSON schema. ONLY fill the fields listed below. Do not attempt to answer Yes/No questions.
+
+JSON Schema to fill:
+{SCHEMA_DESCRIPTION}
+
+Extraction Rules:
+- "transcribed_text" must contain the full transcription and nothing else. If no speech is audible, it must be an empty string "".
+- If information for a key is not in the transcript, the value must be an empty string "".
+- Translate any non-English information (e.g., Hindi, Tamil) into English.
+- Normalize data: write ages and numbers as digits. Format dates clearly.
+"""
+
+
+# --- Helper Functions ---
+@UPLOAD_H.time()
+def upload_audio(audio_file):
+    """Uploads the request's audio stream straight to the Google File API."""
+    # Werkzeug has already spooled the upload into a seekable file object, so we
+    # hand that stream to the File API instead of copying it to disk first.
+    mime_type = audio_file.mimetype or 'application/octet-stream'
+    display_name = f"audio_{os.urandom(8).hex()}"
+    logger.info("Uploading audio to Google File API: %s (%s)", display_name, mime_type)
+    stream = audio_file.stream
+    # The SDK only treats `file` as a stream if it is an io.IOBase. Before Python 3.11
+    # SpooledTemporaryFile is not one, so pass its underlying BytesIO/temp file instead.
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not isinstance(stream, io.IOBase):
+        stream = stream._file
+    stream.seek(0)
+    return genai_client.files.upload(
+        file=stream,
+        config={'display_name': display_name, 'mime_type': mime_type}
+    )
+
+def file_part(file):
+    """Returns a content part referencing an uploaded file, for generate_content."""
+    return {'file_data': {'file_uri': file.uri, 'mime_type': file.mime_type}}
+
+def hash_audio(audio_file):
+    """Returns the SHA-256 hex digest of the uploaded audio, read in chunks."""
+    hasher = hashlib.sha256()
+    stream = audio_file.stream
+    stream.seek(0)
+    while chunk := stream.read(HASH_CHUNK_SIZE):
+        hasher.update(chunk)
+    stream.seek(0) # Rewind so the same stream can be uploaded
+    return hasher.hexdigest()
+
+def audio_size(audio_file):
+    """Returns the size in bytes of the uploaded audio without reading it."""
+    stream = audio_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+# EBML element IDs needed to read block timestamps from a webm file
+EBML_SEGMENT = 0x18538067
+EBML_INFO = 0x1549A766
+EBML_TIMECODE_SCALE = 0x2AD7B1
+EBML_CLUSTER = 0x1F43B675
+EBML_CLUSTER_TIMECODE = 0xE7
+EBML_BLOCK_GROUP = 0xA0
+EBML_BLOCK = 0xA1
+EBML_SIMPLE_BLOCK = 0xA3
+EBML_BLOCK_DURATION = 0x9B
+# Master elements whose children we walk into instead of skipping
+EBML_CONTAINERS = (EBML_SEGMENT, EBML_INFO, EBML_CLUSTER, EBML_BLOCK_GROUP)
+
+def read_ebml_vint(stream, keep_marker=False):
+    """Reads an EBML variable-length integer. Returns (value, is_unknown_size)."""
+    first = stream.read(1)
+    if not first:
+        raise EOFError
+    length = 1
+    mask = 0x80
+    while length <= 8 and not first[0] & mask:
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("Invalid EBML variable-length integer")
+    rest = stream.read(length - 1)
+    if len(rest) < length - 1:
+        raise EOFError
+    value = first[0] if keep_marker else first[0] & (mask - 1)
+    for byte in rest:
+        value = (value << 8) | byte
+    # All data bits set means "unknown size" (used by MediaRecorder for Segment/Cluster)
+    is_unknown = not keep_marker and value == (1 << (7 * length)) - 1
+    return value, is_unknown
+
+def webm_duration_seconds(stream, stop_at=None):
+    """Estimates a webm recording's duration from its block timestamps.
+
+    Walks the EBML tree linearly, adding each SimpleBlock/Block's relative
+    timecode to its Cluster Timecode. The duration runs from the first block's
+    start to the last block's end; the last block's length is its BlockDuration
+    when present, otherwise the gap between the two preceding blocks (one frame).
+    Stops early once `stop_at` seconds have been seen. Returns None if the file
+    cannot be parsed.
+    """
+    timecode_scale = 1_000_000 # Default: timestamps in milliseconds
+    cluster_timecode = 0
+    first_block = last_block = None
+    last_block_length = 0
+
+    def duration_seconds():
+        return (last_block - first_block + last_block_length) * timecode_scale / 1e9
 
+    try:
+        while True:
+            try:
+                element_id, _ = read_ebml_vint(stream, keep_marker=True)
+            except EOFError:
+                break
+            size, is_unknown = read_ebml_vint(stream)
+
+            if element_id in EBML_CONTAINERS:
+                continue
+            if is_unknown:
+                return None
+            if element_id in (EBML_TIMECODE_SCALE, EBML_CLUSTER_TIMECODE, EBML_BLOCK_DURATION):
+                value = int.from_bytes(stream.read(size), 'big')
+                if element_id == EBML_TIMECODE_SCALE:
+                    timecode_scale = value
+                elif element_id == EBML_CLUSTER_TIMECODE:
+                    cluster_timecode = value
+                elif last_block is not None:
+                    last_block_length = value
+            elif element_id in (EBML_SIMPLE_BLOCK, EBML_BLOCK):
+                start = stream.tell()
+                read_ebml_vint(stream) # Track number
+                relative = int.from_bytes(stream.read(2), 'big', signed=True)
+                block_time = cluster_timecode + relative
+                if first_block is None:
+                    first_block = block_time
+                elif block_time > last_block:
+                    last_block_length = block_time - last_block
+                last_block = block_time
+                stream.seek(start + size)
+                if stop_at is not None and duration_seconds() >= stop_at:
+                    break
+            else:
+                stream.seek(size, os.SEEK_CUR)
+    except (EOFError, ValueError):
+        # A truncated final block still leaves us with the timestamps read so far
+        pass
+
+    if first_block is None:
+        return None
+    return duration_seconds()
+
+def check_recording_length(audio_file):
+    """Returns an error message if the recording is too short to send to Gemini."""
+    if audio_file.mimetype in WEBM_MIME_TYPES:
+        stream = audio_file.stream
+        stream.seek(0)
+        duration = webm_duration_seconds(stream, stop_at=MIN_RECORDING_SECONDS)
+        stream.seek(0)
+        if duration is not None:
+            if duration < MIN_RECORDING_SECONDS:
+                return f"Recording is shorter than {MIN_RECORDING_SECONDS} seconds."
+            return None
+        # Unparseable webm: fall back to the byte floor below
+
+    if audio_size(audio_file) < MIN_RECORDING_BYTES:
+        return f"Recording is smaller than {MIN_RECORDING_BYTES} bytes and contains no audio."
+    return None
+
+def get_cached_result(key):
+    with result_cache_lock:
+        return result_cache.get(key)
+
+def cache_result(key, payload):
+    with result_cache_lock:
+        result_cache[key] = payload
+
+def delete_uploaded_file(file_name):
+    """Deletes an uploaded file from the Google File API."""
+    try:
+        genai_client.files.delete(name=file_name)
+        logger.debug("Cleaned up uploaded file: %s", file_name)
+    except Exception as e:
+        logger.warning("Error cleaning up uploaded file (it may auto-delete): %s", e)
+
+@ACTIVATE_H.time()
 def wait_for_file_active(file_response, timeout_sec=30):
     """Waits for the Google File API to mark the file as ACTIVE."""
+    # The upload response already carries a state, so small files are often
+    # ACTIVE before we ever need to poll.
+    if file_response.state.name == 'ACTIVE':
+        return file_response
+
     start_time = time.time()
-    print(f"Waiting for file {file_response.name} to become active...")
-    file = genai.get_file(file_response.name)
+    logger.debug("Waiting for file %s to become active...", file_response.name)
+    delay = 0.1 # Start polling fast, then back off (x1.5, capped at 1 second)
+    file = genai_client.files.get(name=file_response.name)
     while file.state.name == 'PROCESSING':
         if time.time() - start_time > timeout_sec:
             raise Exception(f"File processing timed out after {timeout_sec} seconds.")
-        time.sleep(1) # Wait 1 second before checking again
-        file = genai.get_file(file_response.name)
+        time.sleep(delay * random.uniform(0.8, 1.2)) # Jitter to avoid synchronized polling
+        delay = min(delay * 1.5, 1.0)
+        file = genai_client.files.get(name=file_response.name)
     
     if file.state.name == 'ACTIVE':
-        print(f"File {file.name} is now ACTIVE.")
+        logger.debug("File %s is now ACTIVE.", file.name)
         return file
     else:
         raise Exception(f"File {file.name} failed to process. State: {file.state.name}")
 
+def stream_transcription(response_iter, file_name, cache_key, started_at):
+    """Yields NDJSON lines of transcription text as Gemini streams it back."""
+    parts = []
+    try:
+        for chunk in response_iter:
+            if not chunk.parts:
+                continue
+            parts.append(chunk.text)
+            yield orjson.dumps({'text': chunk.text}) + b"\n"
+
+        TRANSCRIBE_H.observe(time.perf_counter() - started_at)
+
+        transcribed_text = "".join(parts)
+        logger.debug("Transcription result: %r", transcribed_text)
+        if transcribed_text.strip():
+            cache_result(cache_key, {'text': transcribed_text})
+    except Exception as e:
+        logger.exception("An error occurred while streaming transcription: %s", e)
+        yield orjson.dumps({'error': str(e)}) + b"\n"
+    finally:
+        # CRITICAL: Always clean up the uploaded file from Google
+        cleanup_executor.submit(delete_uploaded_file, file_name)
+
 # --- Flask Routes ---
 
+@app.before_request
+def set_batch_upload_limit():
+    # Must run before request.files is touched; needs Flask 3.1+
+    if request.endpoint == 'process_audio_batch':
+        request.max_content_length = MAX_BATCH_BYTES
+
+@app.errorhandler(RequestEntityTooLarge)
+def handle_request_too_large(e):
+    if request.endpoint == 'process_audio_batch':
+        error = (f'Batch upload is too large. The maximum total size is {MAX_BATCH_BYTES // (1024 * 1024)} MB '
+                 f'({MAX_BATCH_FILES} recordings of up to {MAX_RECORDING_BYTES // (1024 * 1024)} MB each).')
+    else:
+        error = f'Recording is too large. The maximum size is {MAX_RECORDING_BYTES // (1024 * 1024)} MB.'
+    return jsonify({'error': error}), 413
+
 @app.route('/process_audio', methods=['POST'])
 def process_audio():
-    print("\n--- Request received for detailed form processing ---")
-    if gemini_model is None:
+    logger.info("Request received for detailed form processing")
+    if gemini_model is None or genai_client is None:
         return jsonify({'error': 'Gemini model failed to load. Check server logs.'}), 500
 
     if 'audio_data' not in request.files:
         return jsonify({'error': 'No audio file found'}), 400
 
     audio_file = request.files['audio_data']
-    
-    # --- FIX: Use the browser's MIME type to determine extension ---
-    mime_type = audio_file.mimetype
-    extension = get_extension_from_mimetype(mime_type)
-    temp_audio_path = os.path.join(TEMP_DIR, f"temp_audio_{uuid.uuid4()}{extension}")
-    print(f"Detected MIME type: {mime_type}, saving to {temp_audio_path}")
-    # --- End Fix ---
+
+    recording_error = check_recording_length(audio_file)
+    if recording_error:
+        logger.info("Rejecting recording: %s", recording_error)
+        return jsonify({'error': recording_error}), 400
+
+    cache_key = ('process_audio', hash_audio(audio_file))
+    cached = get_cached_result(cache_key)
+    if cached is not None:
+        logger.info("Returning cached result for audio %s", cache_key[1])
+        return jsonify(cached)
 
     audio_file_response = None # To hold the Google File API response
     
     try:
-        audio_file.save(temp_audio_path)
-        print(f"Audio saved to: {temp_audio_path}")
-
         # 1. Upload audio to Google File API for transcription
-        print(f"Uploading audio to Google File API: {temp_audio_path}")
-        # --- FIX: Use the original mime_type from the request ---
-        audio_file_response = genai.upload_file(
-            path=temp_audio_path,
-            display_name=os.path.basename(temp_audio_path),
-            mime_type=mime_type 
-        )
-        # --- End Fix ---
+        audio_file_response = upload_audio(audio_file)
         
         # --- FIX: Wait for file to be ACTIVE ---
         active_file_response = wait_for_file_active(audio_file_response)
         # --- End Fix ---
 
-        # 2. Transcribe the entire conversation using Gemini
-        print("Transcribing audio via Gemini API...")
-        transcription_prompt = [
-            "Please transcribe the following audio file. Provide only the text transcription and nothing else.",
-            active_file_response # Use the active file
-        ]
-        transcription_response = gemini_model.generate_content(transcription_prompt)
-        transcribed_text = transcription_response.text
-        print(f"Full Transcription: '{transcribed_text}'")
+        # 2. Transcribe and extract all fields into a JSON object in one Gemini call
+        logger.info("Transcribing and extracting structured data with Gemini...")
+        
+        with EXTRACT_H.time():
+            response = gemini_model.generate_content(
+                [EXTRACTION_PROMPT, file_part(active_file_response)], # Use the active file
+                generation_config={
+                    "response_mime_type": "application/json",
+                    "response_schema": RESPONSE_SCHEMA,
+                }
+            )
+        logger.debug("Gemini Raw Response: %s", response.text)
+
+        extracted_data = orjson.loads(response.text)
+        transcribed_text = extracted_data.pop('transcribed_text', '')
+        logger.debug("Full Transcription: %r", transcribed_text)
 
         if not transcribed_text.strip():
             return jsonify({'error': 'No speech detected.'})
 
-        # 3. Use a sophisticated prompt to extract all fields into a JSON object
-        print("Extracting structured data with Gemini...")
-        
-        schema_description = "\n".join([f'- "{key}": "{description}"' for key, description in VOICE_FILLABLE_SCHEMA.items()])
-
-        prompt = f"""
-        You are an expert medical scribe specializing in dental forms. Your task is to analyze a conversation transcript and extract key information into a structured JSON object.
-
-        Analyze the transcript and fill in the values for the following JSON schema. ONLY fill the fields listed below. Do not attempt to answer Yes/No questions.
-
-        JSON Schema to fill:
-        {schema_description}
-
-        Extraction Rules:
-        - The JSON object must only contain the keys listed in the schema above.
-        - If information for a key is not in the transcript, the value must be an empty string "".
-        - Translate any non-English information (e.g., Hindi, Tamil) into English.
-        - Normalize data: write ages and numbers as digits. Format dates clearly.
-        - Your final output MUST be a single, valid JSON object and nothing else. Do not add explanations.
-
-        Transcript:
-        ---
-        {transcribed_text}
-        ---
-
-        JSON Output:
-        """
-        
-        response = gemini_model.generate_content(prompt)
-        
-        response_text = response.text.strip().replace('```json', '').replace('```', '')
-        print(f"Gemini Raw Response: {response_text}")
+        logger.debug("Successfully Parsed JSON: %s", extracted_data)
 
-        extracted_data = json.loads(response_text)
-        print(f"Successfully Parsed JSON: {extracted_data}")
-
-        return jsonify({
+        result = {
             'transcribed_text': transcribed_text,
             'extracted_data': extracted_data
-        })
+        }
+        cache_result(cache_key, result)
+        return jsonify(result)
 
-    except json.JSONDecodeError:
-        print("Error: Failed to decode JSON from Gemini's response.")
+    except orjson.JSONDecodeError:
+        logger.error("Failed to decode JSON from Gemini's response.")
         return jsonify({'error': "AI response was not valid JSON. Please check server logs."}), 500
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.exception("An error occurred: %s", e)
         return jsonify({'error': str(e)}), 500
     finally:
-        # CRITICAL: Always clean up the temporary file
-        if os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-            print(f"Cleaned up temp file: {temp_audio_path}")
         # CRITICAL: Always clean up the uploaded file from Google
-        try:
-            if audio_file_response:
-                genai.delete_file(audio_file_response.name)
-                print(f"Cleaned up uploaded file: {audio_file_response.name}")
-        except Exception as e:
-            print(f"Error cleaning up uploaded file (it may auto-delete): {e}")
+        if audio_file_response:
+            cleanup_executor.submit(delete_uploaded_file, audio_file_response.name)
 
 @app.route('/transcribe', methods=['POST'])
 def transcribe_field():
-    print("\n--- Request received for single field transcription ---")
-    if gemini_model is None:
+    logger.info("Request received for single field transcription")
+    if gemini_model is None or genai_client is None:
         return jsonify({'error': 'Gemini model failed to load. Check server logs.'}), 500
 
     if 'audio_data' not in request.files:
@@ -226,66 +549,174 @@ def transcribe_field():
 
     audio_file = request.files['audio_data']
 
-    # --- FIX: Use the browser's MIME type to determine extension ---
-    mime_type = audio_file.mimetype
-    extension = get_extension_from_mimetype(mime_type)
-    temp_audio_path = os.path.join(TEMP_DIR, f"temp_audio_{uuid.uuid4()}{extension}")
-    print(f"Detected MIME type: {mime_type}, saving to {temp_audio_path}")
-    # --- End Fix ---
+    # ?stream=1 returns the transcription as NDJSON text deltas as Gemini produces them
+    stream = request.args.get('stream') == '1'
+
+    recording_error = check_recording_length(audio_file)
+    if recording_error:
+        logger.info("Rejecting recording: %s", recording_error)
+        return jsonify({'error': recording_error}), 400
+
+    cache_key = ('transcribe', hash_audio(audio_file))
+    cached = get_cached_result(cache_key)
+    if cached is not None:
+        logger.info("Returning cached result for audio %s", cache_key[1])
+        if stream:
+            return Response(orjson.dumps(cached) + b"\n", mimetype='application/x-ndjson')
+        return jsonify(cached)
     
     audio_file_response = None # To hold the Google File API response
     
     try:
-        audio_file.save(temp_audio_path)
-        print(f"Audio saved to: {temp_audio_path}")
-        
         # 1. Upload audio to Google File API
-        print(f"Uploading audio to Google File API: {temp_audio_path}")
-        # --- FIX: Use the original mime_type from the request ---
-        audio_file_response = genai.upload_file(
-            path=temp_audio_path,
-            display_name=os.path.basename(temp_audio_path),
-            mime_type=mime_type
-        )
-        # --- End Fix ---
+        audio_file_response = upload_audio(audio_file)
         
         # --- FIX: Wait for file to be ACTIVE ---
         active_file_response = wait_for_file_active(audio_file_response)
         # --- End Fix ---
 
         # 2. Transcribe audio using Gemini
-        print("Transcribing audio via Gemini API...")
+        logger.info("Transcribing audio via Gemini API...")
         transcription_prompt = [
             "Please transcribe the following audio file. Provide only the text transcription and nothing else.",
-            active_file_response # Use the active file
+            file_part(active_file_response) # Use the active file
         ]
-        transcription_response = gemini_model.generate_content(transcription_prompt)
+        if stream:
+            started_at = time.perf_counter()
+            response_iter = gemini_model.generate_content(transcription_prompt, stream=True)
+            file_name = audio_file_response.name
+            audio_file_response = None # The generator cleans up once the stream is done
+            return Response(
+                stream_transcription(response_iter, file_name, cache_key, started_at),
+                mimetype='application/x-ndjson'
+            )
+
+        with TRANSCRIBE_H.time():
+            transcription_response = gemini_model.generate_content(transcription_prompt)
         transcribed_text = transcription_response.text
-        print(f"Transcription result: '{transcribed_text}'")
+        logger.debug("Transcription result: %r", transcribed_text)
 
         if not transcribed_text.strip():
             return jsonify({'text': ''})
 
-        return jsonify({'text': transcribed_text})
+        result = {'text': transcribed_text}
+        cache_result(cache_key, result)
+        return jsonify(result)
 
     except Exception as e:
-        print(f"An error occurred during transcription: {e}")
+        logger.exception("An error occurred during transcription: %s", e)
         return jsonify({'error': str(e)}), 500
     finally:
-        # CRITICAL: Always clean up the temporary file
-        if os.path.exists(temp_audio_path):
-            os.remove(temp_audio_path)
-            print(f"Cleaned up temp file: {temp_audio_path}")
         # CRITICAL: Always clean up the uploaded file from Google
+        if audio_file_response:
+            cleanup_executor.submit(delete_uploaded_file, audio_file_response.name)
+
+@app.route('/process_audio_batch', methods=['POST'])
+def process_audio_batch():
+    """Submits several recordings to the Gemini Batch API for offline processing.
+
+    Batch jobs are cheaper than the realtime endpoint but can take minutes to hours;
+    poll /batch_result/<job_id> for the results, which come back in upload order.
+    """
+    logger.info("Request received for batch form processing")
+    if genai_client is None:
+        return jsonify({'error': 'Gemini client failed to load. Check server logs.'}), 500
+
+    audio_files = request.files.getlist('audio_data')
+    if not audio_files:
+        return jsonify({'error': 'No audio file found'}), 400
+    if len(audio_files) > MAX_BATCH_FILES:
+        return jsonify({'error': f'Too many recordings. A batch can hold at most {MAX_BATCH_FILES}.'}), 413
+
+    for audio_file in audio_files:
+        if audio_size(audio_file) > MAX_RECORDING_BYTES:
+            return jsonify({'error': f"{audio_file.filename}: Recording is too large. "
+                                     f"The maximum size is {MAX_RECORDING_BYTES // (1024 * 1024)} MB."}), 413
+        recording_error = check_recording_length(audio_file)
+        if recording_error:
+            return jsonify({'error': f"{audio_file.filename}: {recording_error}"}), 400
+
+    uploaded_files = []
+    try:
+        # Upload everything first so the File API processes the files in parallel;
+        # by the time we poll the later ones, most are already ACTIVE.
+        for audio_file in audio_files:
+            uploaded_files.append(upload_audio(audio_file))
+
+        batch_requests = []
+        for audio_file_response in uploaded_files:
+            active_file_response = wait_for_file_active(audio_file_response)
+            batch_requests.append({
+                'contents': [{
+                    'role': 'user',
+                    'parts': [
+                        {'text': EXTRACTION_PROMPT},
+                        file_part(active_file_response),
+                    ],
+                }],
+                'config': {
+                    'response_mime_type': 'application/json',
+                    'response_schema': BATCH_RESPONSE_SCHEMA,
+                },
+            })
+
+        batch_job = genai_client.batches.create(
+            model=GEMINI_MODEL_NAME,
+            src=batch_requests,
+            config={'display_name': f"process_audio_batch_{os.urandom(8).hex()}"},
+        )
+        logger.info("Submitted batch job %s with %d recordings", batch_job.name, len(batch_requests))
+
+        # The uploaded files must stay available until the job has run, so they are
+        # not deleted here; the File API expires them automatically after 48 hours.
+        return jsonify({
+            'job_id': batch_job.name,
+            'files': [audio_file.filename for audio_file in audio_files]
+        }), 202
+
+    except Exception as e:
+        logger.exception("An error occurred while submitting the batch: %s", e)
+        for audio_file_response in uploaded_files:
+            cleanup_executor.submit(delete_uploaded_file, audio_file_response.name)
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/batch_result/<path:job_id>', methods=['GET'])
+def batch_result(job_id):
+    """Returns the state of a batch job and, once it has succeeded, its results."""
+    if genai_client is None:
+        return jsonify({'error': 'Gemini client failed to load. Check server logs.'}), 500
+
+    try:
+        batch_job = genai_client.batches.get(name=job_id)
+    except Exception as e:
+        logger.exception("An error occurred while fetching batch %s: %s", job_id, e)
+        return jsonify({'error': str(e)}), 500
+
+    state = batch_job.state.name
+    if state != 'JOB_STATE_SUCCEEDED':
+        return jsonify({'job_id': job_id, 'state': state})
+
+    results = []
+    for inlined_response in batch_job.dest.inlined_responses:
+        if inlined_response.error:
+            results.append({'error': str(inlined_response.error)})
+            continue
         try:
-            if audio_file_response:
-                genai.delete_file(audio_file_response.name)
-                print(f"Cleaned up uploaded file: {audio_file_response.name}")
-        except Exception as e:
-            print(f"Error cleaning up uploaded file (it may auto-delete): {e}")
+            extracted_data = orjson.loads(inlined_response.response.text)
+        except orjson.JSONDecodeError:
+            results.append({'error': "AI response was not valid JSON."})
+            continue
+        transcribed_text = extracted_data.pop('transcribed_text', '')
+        results.append({
+            'transcribed_text': transcribed_text,
+            'extracted_data': extracted_data
+        })
+
+    return jsonify({'job_id': job_id, 'state': state, 'results': results})
 
 # This block is for local development.
-# Render will use a WSGI server like Gunicorn and will not run this.
+# In production run Gunicorn with threaded workers instead (see gunicorn_conf.py):
+#   gunicorn -c gunicorn_conf.py app:app
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=True)
\ No newline at end of file
@@ -0,0 +1,26 @@
+# Gunicorn settings for production (Render).
+# Run from the api/ directory with:  gunicorn -c gunicorn_conf.py app:app
+#
+# Almost all request time is spent waiting on Gemini (upload + generate_content),
+# so we use threaded workers: each in-flight request holds a thread, not a whole
+# process, and a couple of workers can serve dozens of concurrent requests.
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+worker_class = "gthread"
+threads = int(os.environ.get('GUNICORN_THREADS', 32))
+
+# No custom `timeout`: with gthread it is only the worker heartbeat, which the
+# main loop keeps sending while request threads wait on Gemini, so it does not
+# limit how long a request may run. The default is left in place.
+keepalive = 5
+
+
+# When PROMETHEUS_MULTIPROC_DIR is set, app.py aggregates metrics across workers;
+# drop a worker's live metric files when it exits.
+def child_exit(server, worker):
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
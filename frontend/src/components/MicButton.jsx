@@ -83,16 +83,36 @@ function MicButton({ onTranscription, fieldId, onStatusChange }) {
         formData.append('audio_data', audioBlob);
 
         try {
-            const response = await fetch('https://dentalbot-375s.onrender.com/transcribe', {
+            const response = await fetch('https://dentalbot-375s.onrender.com/transcribe?stream=1', {
                 method: 'POST',
                 body: formData
             });
             if (!response.ok) throw new Error('Server error during transcription');
 
-            const result = await response.json();
-            if (result.error) throw new Error(result.error);
-            
-            onTranscription(fieldId, result.text);
+            // The server streams newline-delimited JSON ({"text": ...} deltas),
+            // so fill the field progressively as each line arrives.
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffered = '';
+            let text = '';
+            const handleLine = (line) => {
+                if (!line.trim()) return;
+                const result = JSON.parse(line);
+                if (result.error) throw new Error(result.error);
+                text += result.text;
+                onTranscription(fieldId, text);
+            };
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                buffered += decoder.decode(value, { stream: true });
+                const lines = buffered.split('\n');
+                buffered = lines.pop();
+                lines.forEach(handleLine);
+            }
+            handleLine(buffered + decoder.decode());
+
+            onTranscription(fieldId, text);
             onStatusChange(`Transcription completed.`, 'green');
 
         } catch (error) {